@@ -1,26 +1,36 @@
 import os
 
-def count_files(directory):
-    # Initialize a counter for files
-    file_count = 0
+def count_non_json(*directories):
+    # Initialize a counter for each directory
+    file_counts = [0] * len(directories)
 
-    # Walk through the directory and its subdirectories
-    for root, dirs, files in os.walk(directory):
-        for file in files:
-            # Check if the file is not a JSON file
-            if not file.endswith('.json'):
-                file_count += 1
+    # Scan all directories and their subdirectories in one pass, one os.scandir per directory
+    pending = [(directory, index) for index, directory in enumerate(directories)]
+    while pending:
+        path, index = pending.pop()
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        # Like os.walk, symlinks to directories are neither counted nor followed
+                        if entry.is_dir(follow_symlinks=False):
+                            pending.append((entry.path, index))
+                    # Check if the file is not a JSON file
+                    elif not entry.name.endswith('.json'):
+                        file_counts[index] += 1
+        except OSError as e:
+            # Skip directories that cannot be read, like os.walk did
+            print(f"Failed to scan directory {path}: {e}")
 
-    return file_count
+    return file_counts
 
 if __name__ == "__main__":
     # Specify the directory you want to count files in
     target_directory = "E:\\takeout\\Takeout\\Albums_processed\\"
     target_directory1 = "E:\\takeout\\Takeout\\Photos\\"
 
-    # Call the function to count files
-    total_files = count_files(target_directory)
-    total_files1 = count_files(target_directory1)
+    # Call the function to count files in both directories
+    total_files, total_files1 = count_non_json(target_directory, target_directory1)
 
     print(f"album: {total_files} gp: {total_files1} diff: {total_files1 - total_files}")
 
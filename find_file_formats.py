@@ -1,18 +1,29 @@
 import os
 import json
 from exif import Image
-import pathlib
 
 def merge_metadata(media_folder):
-    media_extensions = []
+    media_extensions = set()
 
-    for root, dirs, files in os.walk(media_folder):
-        for file in files:
-          extension = pathlib.Path(file).suffix
-          if (extension != '.json') and (extension not in media_extensions):
-            media_extensions.append(extension)
+    pending = [media_folder]
+    while pending:
+        path = pending.pop()
+        try:
+          with os.scandir(path) as entries:
+            for entry in entries:
+              if entry.is_dir():
+                # Like os.walk, symlinks to directories are neither listed nor followed
+                if entry.is_dir(follow_symlinks=False):
+                  pending.append(entry.path)
+                continue
+              extension = os.path.splitext(entry.name)[1]
+              if extension != '.json':
+                media_extensions.add(extension)
+        except OSError as e:
+          # Skip directories that cannot be read, like os.walk did
+          print(f"Failed to scan directory {path}: {e}")
 
-    print(media_extensions)
+    print(sorted(media_extensions))
     # for root, dirs, files in os.walk(media_folder):
     #     for file in files:
     #         if '.' + file.split(".")[-1] in media_extensions:
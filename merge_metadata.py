@@ -1,24 +1,87 @@
 import os
-import json
+import atexit
+import errno
+import functools
 import logging
+import logging.handlers
+import queue
 import shutil
+import struct
 import subprocess
-from PIL import Image
+import threading
+import zlib
+from PIL import Image, UnidentifiedImageError
 import piexif
 from mutagen.mp4 import MP4, MP4Tags
 from datetime import datetime
 import ffmpeg  # Import ffmpeg module
 
-# Set up logging
+# orjson parses the JSON sidecars several times faster, fall back to the json module without it
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+class BufferedFileHandler(logging.FileHandler):
+    """FileHandler that writes through a 1 MiB buffer, flushed only when the file is closed."""
+
+    def _open(self):
+        return open(self.baseFilename, self.mode, buffering=1 << 20, encoding=self.encoding, errors=self.errors)
+
+    def flush(self):
+        # The buffer is written out by close() when logging shuts down
+        pass
+
+# Set up logging: the worker threads only put records on a queue, a listener thread writes them
+# Level of the per-file messages, INFO logs every processed file (unknown names map to a string)
+LOG_LEVEL = logging.getLevelName((os.environ.get("METADATA_LOG_LEVEL") or "WARNING").upper())
+log_formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+log_handlers = [
+    BufferedFileHandler("metadata_update.log", mode='w', encoding='utf-8'),  # Overwrite log file each run
+    logging.StreamHandler()  # Log to console
+]
+for handler in log_handlers:
+    handler.setFormatter(log_formatter)
+log_queue = queue.SimpleQueue()
+log_listener = logging.handlers.QueueListener(log_queue, *log_handlers)
 logging.basicConfig(
-    level=logging.INFO,  # Log all messages
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler("metadata_update.log", mode='w'),  # Overwrite log file each run
-        logging.StreamHandler()  # Log to console
-    ]
+    level=logging.INFO,
+    format="%(message)s",  # Formatted by the listener's handlers
+    handlers=[logging.handlers.QueueHandler(log_queue)]
 )
+log_listener.start()
+atexit.register(log_listener.stop)  # Runs before logging closes (and flushes) the handlers
+
+# Per-file messages, filtered by METADATA_LOG_LEVEL
 logger = logging.getLogger(__name__)
+if not isinstance(LOG_LEVEL, int):
+    logger.warning(f"Unknown METADATA_LOG_LEVEL {os.environ['METADATA_LOG_LEVEL']!r}, using WARNING")
+    LOG_LEVEL = logging.WARNING
+logger.setLevel(LOG_LEVEL)
+
+# Once-per-run messages (start, per-directory counts, completion), logged whatever METADATA_LOG_LEVEL is
+summary_logger = logging.getLogger(f"{__name__}.summary")
+summary_logger.setLevel(logging.INFO)
+
+# Number of threads processing media files (the work is mostly disk I/O)
+MAX_WORKERS = (os.cpu_count() or 1) * 2
+
+# FFmpeg conversions are multithreaded themselves, so only a few run at the same time
+TRANSCODE_WORKERS = 4
+transcode_slots = threading.BoundedSemaphore(TRANSCODE_WORKERS)
+
+# Media files scanned ahead of the workers, bounds the memory used by the queue
+QUEUE_SIZE = 1024
+
+# Media file extensions (lowercase) grouped by how the files are handled
+JPEG_EXTS = {'.jpg', '.jpeg'}
+MP4_EXTS = {'.mp4', '.mov'}
+TRANSCODE_EXTS = {'.wmv', '.avi', '.mpg', '.3gp'}
+
+# The only fields of the JSON sidecars used to update the media files
+METADATA_FIELDS = ('photoTakenTime', 'geoData', 'description')
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
 
 def remove_thumbnail(exif_dict):
     """Remove the thumbnail from the EXIF data."""
@@ -55,23 +118,36 @@ def validate_exif_value(value):
         return None
 
 def clean_exif_dict(exif_dict):
-    """Clean the EXIF dictionary to remove or fix invalid tags."""
+    """Clean the EXIF dictionary to remove invalid tags."""
     for ifd in exif_dict:
         if ifd == 'thumbnail':
             continue  # Skip the thumbnail
-        for tag in list(exif_dict[ifd].keys()):
+        # Handle the problematic tag 41729 (SceneType)
+        if 41729 in exif_dict[ifd]:
+            logger.warning(f"Removing invalid EXIF tag 41729 in {ifd}")
+            del exif_dict[ifd][41729]  # Remove the invalid tag
+    return exif_dict
+
+def dump_exif(exif_dict, media_path):
+    """Dump the EXIF dictionary to bytes, removing the tags piexif cannot write if it fails."""
+    try:
+        return piexif.dump(exif_dict)
+    except Exception as e:
+        logger.warning(f"Invalid EXIF metadata in {media_path}: {e}")
+
+    # Only reached for broken EXIF data of the photo itself (the fields taken from the JSON
+    # metadata are checked before they are merged): find the invalid tags one at a time
+    for ifd in ("0th", "Exif", "GPS", "Interop", "1st"):
+        for tag in list(exif_dict.get(ifd, {})):
+            probe = {ifd: {tag: exif_dict[ifd][tag]}}
+            if ifd == "Interop":
+                probe["Exif"] = {}  # piexif only writes the Interop IFD inside an Exif IFD
             try:
-                # Handle the problematic tag 41729 (SceneType)
-                if tag == 41729:
-                    logger.warning(f"Removing invalid EXIF tag {tag} in {ifd}")
-                    del exif_dict[ifd][tag]  # Remove the invalid tag
-                else:
-                    # Validate the value for other tags
-                    validate_exif_value(exif_dict[ifd][tag])
+                piexif.dump(probe)
             except Exception as e:
                 logger.warning(f"Removing invalid EXIF tag {tag} in {ifd}: {e}")
                 del exif_dict[ifd][tag]  # Remove the invalid tag
-    return exif_dict
+    return piexif.dump(exif_dict)
 
 def parse_timestamp(timestamp):
     """Parse the timestamp from the JSON metadata."""
@@ -83,116 +159,247 @@ def parse_timestamp(timestamp):
         logger.error(f"Failed to parse timestamp {timestamp}: {e}")
         return None
 
-def convert_nef_to_jpg(nef_path, jpg_path, exif_bytes):
-    """Convert a .nef file to .jpg while preserving metadata."""
+def convert_nef_to_jpg(img, nef_path, exif_bytes):
+    """Save an opened .nef image as .jpg with the given EXIF metadata, returning the .jpg path."""
+    jpg_path = os.path.splitext(nef_path)[0] + ".jpg"
     try:
         logger.info(f"Converting .nef file to .jpg: {nef_path}")
-        with Image.open(nef_path) as img:
-            # Save as .jpg with the provided EXIF metadata
-            img.save(jpg_path, "jpeg", exif=exif_bytes, quality=95)  # Adjust quality as needed
-            logger.info(f"Successfully converted {nef_path} to {jpg_path}")
-            return True
+        # Save as .jpg with the provided EXIF metadata, decoding the raw image only once
+        img.save(jpg_path, "jpeg", exif=exif_bytes, quality=95)  # Adjust quality as needed
+        logger.info(f"Successfully converted {nef_path} to {jpg_path}")
+        return jpg_path
     except Exception as e:
         logger.error(f"Failed to convert .nef file {nef_path} to .jpg: {e}")
-        return False
+        return None
+
+# Directories of the processed folder created by this run
+created_dirs = set()
+
+def ensure_dir(directory):
+    """Create a directory unless this run already did, saving the makedirs stat calls."""
+    if directory not in created_dirs:
+        os.makedirs(directory, exist_ok=True)
+        created_dirs.add(directory)
+
+def move_file(src, dst):
+    """Move a file with a single rename, copying it only when it has to go to another drive."""
+    try:
+        os.replace(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(src, dst)
+
+def read_png_exif(png_path):
+    """Read the raw EXIF data from the eXIf chunk of a PNG file (None if there is none)."""
+    with open(png_path, 'rb') as f:
+        if f.read(8) != PNG_SIGNATURE:
+            raise ValueError(f"Not a PNG file: {png_path}")
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return None
+            length, chunk_type = struct.unpack('>I4s', header)
+            if chunk_type == b'eXIf':
+                return f.read(length)
+            if chunk_type == b'IEND':
+                return None
+            f.seek(length + 4, os.SEEK_CUR)  # Skip the chunk data and its CRC
+
+def insert_png_exif(exif_bytes, png_path):
+    """Write the EXIF data into the eXIf chunk of a PNG file without re-encoding the image."""
+    with open(png_path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(PNG_SIGNATURE):
+        raise ValueError(f"Not a PNG file: {png_path}")
+
+    # The eXIf chunk holds the TIFF data without the "Exif\0\0" header of the JPEG APP1 segment
+    if exif_bytes.startswith(b'Exif\x00\x00'):
+        exif_bytes = exif_bytes[6:]
+    exif_chunk = (
+        struct.pack('>I', len(exif_bytes)) + b'eXIf' + exif_bytes
+        + struct.pack('>I', zlib.crc32(b'eXIf' + exif_bytes))
+    )
+
+    # Copy the chunks as they are, replacing any existing eXIf chunk with one before the first IDAT
+    chunks = [PNG_SIGNATURE]
+    pos = len(PNG_SIGNATURE)
+    while pos < len(data):
+        if pos + 8 > len(data):
+            raise ValueError(f"Truncated PNG file: {png_path}")
+        length, chunk_type = struct.unpack('>I4s', data[pos:pos + 8])
+        end = pos + length + 12  # Length, type, data and CRC
+        if chunk_type == b'IDAT' and exif_chunk:
+            chunks.append(exif_chunk)
+            exif_chunk = None
+        if chunk_type != b'eXIf':
+            chunks.append(data[pos:end])
+        pos = end
+        if chunk_type == b'IEND':
+            chunks.append(data[pos:])
+            break
+    if exif_chunk:
+        raise ValueError(f"No image data found in PNG file: {png_path}")
+
+    with open(png_path, 'wb') as f:
+        f.write(b''.join(chunks))
+
+def set_exif_fields(exif_dict, datetime_original, latitude, longitude, description):
+    """Write the fields taken from the JSON metadata into an EXIF dictionary."""
+    if datetime_original:
+        # Ensure DateTimeOriginal is set in the Exif IFD
+        exif_dict['Exif'][piexif.ExifIFD.DateTimeOriginal] = datetime_original
+        # Also set DateTime in the 0th IFD (optional, for compatibility)
+        exif_dict['0th'][piexif.ImageIFD.DateTime] = datetime_original
+
+    if latitude is not None and longitude is not None:
+        exif_dict['GPS'][piexif.GPSIFD.GPSLatitude] = [(latitude, 1)]
+        exif_dict['GPS'][piexif.GPSIFD.GPSLongitude] = [(longitude, 1)]
+
+    if description is not None:
+        exif_dict['0th'][piexif.ImageIFD.ImageDescription] = description
+
+    return exif_dict
+
+@functools.lru_cache(maxsize=4096)
+def dump_new_exif(datetime_original, latitude, longitude, description):
+    """Dump new EXIF data that only holds the fields taken from the JSON metadata.
+
+    Photos without EXIF metadata of their own often get identical fields (a burst
+    taken in the same second and place), so the dumped bytes are cached.
+    """
+    exif_dict = {"0th": {}, "Exif": {}, "GPS": {}, "Interop": {}, "1st": {}, "thumbnail": None}
+    return piexif.dump(set_exif_fields(exif_dict, datetime_original, latitude, longitude, description))
+
+def build_exif_bytes(exif_dict, metadata, directory_photo_taken_time, media_path):
+    """Merge the JSON metadata into the EXIF data of a photo and dump it to bytes."""
+    # Update the DateTimeOriginal field
+    if metadata and 'photoTakenTime' in metadata:
+        timestamp = metadata['photoTakenTime'].get('timestamp')
+    elif directory_photo_taken_time:
+        # Use the directory's photoTakenTime if no metadata is found
+        timestamp = directory_photo_taken_time
+    else:
+        logger.warning(f"No timestamp found in metadata or directory for: {media_path}")
+        return None
+
+    datetime_original = None
+    if timestamp:
+        datetime_original = parse_timestamp(timestamp)
+        if not datetime_original:
+            logger.warning(f"Invalid timestamp in metadata for: {media_path}")
+    else:
+        logger.warning(f"No timestamp found in metadata for: {media_path}")
+
+    latitude = longitude = None
+    if metadata and 'geoData' in metadata:
+        geo_latitude = metadata['geoData'].get('latitude')
+        geo_longitude = metadata['geoData'].get('longitude')
+        if geo_latitude is not None and geo_longitude is not None:
+            latitude, longitude = int(geo_latitude), int(geo_longitude)
+
+    description = None
+    if metadata and 'description' in metadata:
+        description = validate_exif_value(metadata['description'])
+
+    # Dump the fields taken from the JSON metadata on their own, reusing the bytes of identical
+    # fields. This checks them before they are merged: piexif rejects e.g. negative coordinates,
+    # and such a photo fails instead of being half tagged, whether or not it has EXIF metadata
+    try:
+        new_exif_bytes = dump_new_exif(datetime_original, latitude, longitude, description)
+    except Exception as e:
+        logger.error(f"Invalid EXIF fields in the JSON metadata of {media_path}: {e}")
+        return None
+
+    # Use the new EXIF metadata as is if the photo has none
+    if not exif_dict or not any(exif_dict.get(ifd) for ifd in ("0th", "Exif", "GPS", "Interop", "1st")):
+        logger.info(f"No EXIF metadata found in: {media_path}. Creating new EXIF metadata.")
+        return new_exif_bytes
+
+    # Remove the thumbnail to avoid "Given thumbnail is too large" error
+    exif_dict = remove_thumbnail(exif_dict)
+
+    # Clean the EXIF dictionary to remove or fix invalid tags
+    exif_dict = clean_exif_dict(exif_dict)
+
+    # Dump the EXIF dictionary to bytes
+    return dump_exif(set_exif_fields(exif_dict, datetime_original, latitude, longitude, description), media_path)
 
 def update_photo_metadata(media_path, metadata, directory_photo_taken_time):
     """Update metadata for photo files."""
+    ext = os.path.splitext(media_path)[1].lower()
     try:
-        if media_path.lower().endswith(('.jpg', '.jpeg', '.png', '.nef')):
-            # Handle JPG, PNG, and NEF files using piexif
+        if ext in JPEG_EXTS:
+            # Only the EXIF segment of the JPEG is read and rewritten, the image is never decoded
             logger.info(f"Processing photo: {media_path}")
+            try:
+                exif_dict = piexif.load(media_path)
+            except (OSError, ValueError) as e:
+                logger.error(f"Corrupted or truncated image file: {media_path}. Skipping. Error: {e}")
+                return False
+
+            exif_bytes = build_exif_bytes(exif_dict, metadata, directory_photo_taken_time, media_path)
+            if exif_bytes is None:
+                return False
 
-            # Check if the file is corrupted or truncated
             try:
-                img = Image.open(media_path)
-                img.verify()  # Verify the file integrity
-                img.close()  # Close and reopen the file for processing
-                img = Image.open(media_path)
-            except Exception as e:
+                piexif.insert(exif_bytes, media_path)
+            except (OSError, ValueError) as e:
                 logger.error(f"Corrupted or truncated image file: {media_path}. Skipping. Error: {e}")
                 return False
 
-            # Initialize an empty EXIF dictionary if no EXIF metadata exists
-            if "exif" not in img.info:
-                logger.info(f"No EXIF metadata found in: {media_path}. Creating new EXIF metadata.")
-                exif_dict = {"0th": {}, "Exif": {}, "GPS": {}, "Interop": {}, "1st": {}, "thumbnail": None}
-            else:
-                exif_dict = piexif.load(img.info['exif'])
+            logger.info(f"Successfully updated metadata for photo: {media_path}")
+            return True
 
-            # Remove the thumbnail to avoid "Given thumbnail is too large" error
-            exif_dict = remove_thumbnail(exif_dict)
+        elif ext == '.png':
+            # Same for PNG files through their eXIf chunk
+            logger.info(f"Processing photo: {media_path}")
+            try:
+                raw_exif = read_png_exif(media_path)
+                exif_dict = piexif.load(raw_exif) if raw_exif else None
+            except (OSError, ValueError) as e:
+                logger.error(f"Corrupted or truncated image file: {media_path}. Skipping. Error: {e}")
+                return False
 
-            # Clean the EXIF dictionary to remove or fix invalid tags
-            exif_dict = clean_exif_dict(exif_dict)
+            exif_bytes = build_exif_bytes(exif_dict, metadata, directory_photo_taken_time, media_path)
+            if exif_bytes is None:
+                return False
 
-            # Update the DateTimeOriginal field
-            if metadata and 'photoTakenTime' in metadata:
-                timestamp = metadata['photoTakenTime'].get('timestamp')
-            elif directory_photo_taken_time:
-                # Use the directory's photoTakenTime if no metadata is found
-                timestamp = directory_photo_taken_time
-            else:
-                logger.warning(f"No timestamp found in metadata or directory for: {media_path}")
-                img.close()  # Close the image before returning
+            try:
+                insert_png_exif(exif_bytes, media_path)
+            except (OSError, ValueError) as e:
+                logger.error(f"Corrupted or truncated image file: {media_path}. Skipping. Error: {e}")
                 return False
 
-            if timestamp:
-                datetime_original = parse_timestamp(timestamp)
-                if datetime_original:
-                    # Ensure DateTimeOriginal is set in the Exif IFD
-                    exif_dict['Exif'][piexif.ExifIFD.DateTimeOriginal] = datetime_original
-                    # Also set DateTime in the 0th IFD (optional, for compatibility)
-                    exif_dict['0th'][piexif.ImageIFD.DateTime] = datetime_original
-                else:
-                    logger.warning(f"Invalid timestamp in metadata for: {media_path}")
-            else:
-                logger.warning(f"No timestamp found in metadata for: {media_path}")
+            logger.info(f"Successfully updated metadata for photo: {media_path}")
+            return True
 
-            if metadata and 'geoData' in metadata:
-                latitude = metadata['geoData'].get('latitude')
-                longitude = metadata['geoData'].get('longitude')
-                if latitude is not None and longitude is not None:
-                    exif_dict['GPS'][piexif.GPSIFD.GPSLatitude] = [(int(latitude), 1)]
-                    exif_dict['GPS'][piexif.GPSIFD.GPSLongitude] = [(int(longitude), 1)]
+        elif ext == '.nef':
+            # Handle .nef files by decoding them with PIL and converting them to .jpg
+            logger.info(f"Processing photo: {media_path}")
+            try:
+                img = Image.open(media_path)
+            except (UnidentifiedImageError, OSError) as e:
+                logger.error(f"Corrupted or truncated image file: {media_path}. Skipping. Error: {e}")
+                return False
 
-            if metadata and 'description' in metadata:
-                description = validate_exif_value(metadata['description'])
-                if description is not None:
-                    exif_dict['0th'][piexif.ImageIFD.ImageDescription] = description
-
-            # Dump the EXIF dictionary to bytes
-            exif_bytes = piexif.dump(exif_dict)
-
-            # Handle .nef files by converting them to .jpg
-            if media_path.lower().endswith('.nef'):
-                jpg_path = os.path.splitext(media_path)[0] + ".jpg"
-                if convert_nef_to_jpg(media_path, jpg_path, exif_bytes):
-                    # Close the original image before deleting the .nef file
-                    img.close()
-                    # Delete the original .nef file after successful conversion
-                    os.remove(media_path)
-                    media_path = jpg_path  # Update the media_path to the new .jpg file
-                    # Reopen the new .jpg file for further processing
-                    img = Image.open(media_path)
-                else:
-                    img.close()
+            with img:
+                exif_dict = piexif.load(img.info['exif']) if "exif" in img.info else None
+                exif_bytes = build_exif_bytes(exif_dict, metadata, directory_photo_taken_time, media_path)
+                if exif_bytes is None:
                     return False
 
-            # Save the image with the updated EXIF metadata
-            if media_path.lower().endswith(('.jpg', '.jpeg')):
-                img.save(media_path, "jpeg", exif=exif_bytes)
-            elif media_path.lower().endswith('.png'):
-                # For PNG files, we need to use the `pnginfo` parameter
-                png_info = img.info
-                png_info["exif"] = exif_bytes
-                img.save(media_path, "png", **png_info)
-            img.close()
+                jpg_path = convert_nef_to_jpg(img, media_path, exif_bytes)
+                if jpg_path is None:
+                    return False
 
-            logger.info(f"Successfully updated metadata for photo: {media_path}")
+            # Delete the original .nef file after successful conversion (the image is closed now)
+            os.remove(media_path)
+
+            logger.info(f"Successfully updated metadata for photo: {jpg_path}")
             return True
 
-        elif media_path.lower().endswith('.gif'):
+        elif ext == '.gif':
             # Handle GIF files (skip metadata updates)
             logger.warning(f"Skipping metadata update for .gif file: {media_path} (GIF metadata not supported)")
             return False
@@ -205,10 +412,108 @@ def update_photo_metadata(media_path, metadata, directory_photo_taken_time):
         logger.error(f"Failed to update metadata for photo {media_path}: {e}")
         return False
 
-def update_video_metadata(media_path, metadata, processed_folder):
+def get_mp4_codecs(media_path):
+    """Pick the FFmpeg codecs to convert a video to MP4, copying the streams MP4 can already hold.
+
+    The audio codec is None for videos without an audio stream.
+    """
+    try:
+        streams = ffmpeg.probe(media_path).get('streams', [])
+    except ffmpeg.Error as e:
+        logger.warning(f"FFmpeg probe failed for {media_path}, re-encoding all streams: {e.stderr.decode('utf-8') if e.stderr else 'Unknown error'}")
+        return 'libx264', 'aac'
+
+    video_codec = next((stream.get('codec_name') for stream in streams if stream.get('codec_type') == 'video'), None)
+    audio_codec = next((stream.get('codec_name') for stream in streams if stream.get('codec_type') == 'audio'), None)
+
+    # H.264 video and AAC audio are only remuxed, anything else is transcoded
+    vcodec = 'copy' if video_codec == 'h264' else 'libx264'
+    if audio_codec is None:
+        acodec = None
+    else:
+        acodec = 'copy' if audio_codec == 'aac' else 'aac'
+    return vcodec, acodec
+
+def convert_to_mp4(media_path, mp4_path, vcodec, acodec, metadata_args):
+    """Convert a video to MP4 with FFmpeg, setting the given key=value metadata."""
+    # Copied AVI/MPG streams often lack timestamps, let FFmpeg generate them
+    input_args = {'fflags': '+genpts'} if 'copy' in (vcodec, acodec) else {}
+    if acodec is None:
+        acodec = 'copy'  # No audio stream, nothing to encode
+    (
+        ffmpeg.input(media_path, **input_args)
+        .output(
+            mp4_path,
+            format='mp4',
+            vcodec=vcodec,
+            acodec=acodec,
+            metadata=metadata_args  # Pass metadata as a list of key=value strings
+        )
+        .overwrite_output()
+        .run()
+    )
+
+class ExifToolServer:
+    """One exiftool process kept running in -stay_open mode and fed commands over stdin.
+
+    Starting exiftool takes a few hundred milliseconds (more on Windows), so all
+    commands share a single process, started on first use.
+    """
+
+    def __init__(self, executable='exiftool'):
+        self.executable = executable
+        self.process = None
+        self.lock = threading.Lock()
+
+    def execute(self, *args):
+        """Run one exiftool command and return its output."""
+        with self.lock:
+            if self.process is None:
+                self.process = subprocess.Popen(
+                    [self.executable, '-stay_open', 'True', '-@', '-', '-common_args', '-charset', 'filename=utf8'],
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT
+                )
+
+            # One argument per line, -execute runs the command and exiftool answers with {ready}
+            command = '\n'.join(args) + '\n-execute\n'
+            self.process.stdin.write(command.encode('utf-8'))
+            self.process.stdin.flush()
+
+            output = []
+            while True:
+                line = self.process.stdout.readline()
+                if not line:
+                    # exiftool exited, start a new process for the next command
+                    returncode = self.process.wait()
+                    self.process = None
+                    raise subprocess.CalledProcessError(returncode, [self.executable, *args], b''.join(output))
+                if line.strip() == b'{ready}':
+                    break
+                output.append(line)
+
+        output = b''.join(output)
+        if b'Error:' in output or b"weren't updated due to errors" in output:
+            raise subprocess.CalledProcessError(1, [self.executable, *args], output)
+        return output.decode('utf-8', errors='replace')
+
+    def close(self):
+        """Stop the exiftool process if it was started."""
+        with self.lock:
+            if self.process is not None:
+                self.process.stdin.write(b'-stay_open\nFalse\n')
+                self.process.stdin.flush()
+                self.process.communicate()
+                self.process = None
+
+exiftool_server = ExifToolServer()
+
+def update_video_metadata(media_path, metadata, processed_dir):
     """Update metadata for video files."""
+    ext = os.path.splitext(media_path)[1].lower()
     try:
-        if media_path.lower().endswith(('.mp4', '.mov')):
+        if ext in MP4_EXTS:
             # Handle MP4/MOV files using mutagen
             logger.info(f"Processing video: {media_path}")
             video = MP4(media_path)
@@ -234,7 +539,7 @@ def update_video_metadata(media_path, metadata, processed_folder):
             logger.info(f"Successfully updated metadata for video: {media_path}")
             return True
 
-        elif media_path.lower().endswith(('.wmv', '.avi', '.mpg', '.3gp')):
+        elif ext in TRANSCODE_EXTS:
             # Handle WMV, AVI, MPG, 3GP files by converting them to MP4
             logger.info(f"Processing video: {media_path}")
             creation_time = None
@@ -262,20 +567,20 @@ def update_video_metadata(media_path, metadata, processed_folder):
             # Log the metadata arguments being passed to FFmpeg
             logger.info(f"FFmpeg metadata_args: {metadata_args}")
 
+            # Copy the streams that are already MP4 compatible instead of re-encoding them
+            vcodec, acodec = get_mp4_codecs(media_path)
+            logger.info(f"FFmpeg codecs for {media_path}: video={vcodec}, audio={acodec}")
+
             # Use FFmpeg to convert the video to MP4 and set metadata
             try:
-                (
-                    ffmpeg.input(media_path)
-                    .output(
-                        mp4_path,
-                        format='mp4',
-                        vcodec='libx264',
-                        acodec='aac',
-                        metadata=metadata_args  # Pass metadata as a list of key=value strings
-                    )
-                    .overwrite_output()
-                    .run()
-                )
+                try:
+                    convert_to_mp4(media_path, mp4_path, vcodec, acodec, metadata_args)
+                except ffmpeg.Error as e:
+                    if 'copy' not in (vcodec, acodec):
+                        raise  # Nothing was copied, re-encoding again would fail the same way
+                    # Some streams cannot be remuxed into MP4 as they are, re-encode them instead
+                    logger.warning(f"FFmpeg stream copy failed for {media_path}, re-encoding: {e.stderr.decode('utf-8') if e.stderr else 'Unknown error'}")
+                    convert_to_mp4(media_path, mp4_path, 'libx264', 'aac' if acodec else None, metadata_args)
                 logger.info(f"FFmpeg conversion completed for: {media_path}")
             except ffmpeg.Error as e:
                 logger.error(f"FFmpeg error: {e.stderr.decode('utf-8') if e.stderr else 'Unknown error'}")
@@ -287,25 +592,19 @@ def update_video_metadata(media_path, metadata, processed_folder):
             # Use exiftool to ensure metadata is correctly embedded
             if creation_time:
                 try:
-                    subprocess.run(
-                        ['exiftool', '-overwrite_original', '-CreateDate=' + creation_time, mp4_path],
-                        check=True
-                    )
+                    exiftool_server.execute('-overwrite_original', '-CreateDate=' + creation_time, mp4_path)
                     logger.info(f"Successfully set creation_time for {mp4_path} using exiftool")
                 except subprocess.CalledProcessError as e:
                     logger.error(f"Failed to set creation_time for {mp4_path} using exiftool: {e}")
                     return False
 
-            # Move the new MP4 file to the processed folder
-            relative_path = os.path.relpath(mp4_path, media_folder)
-            processed_path = os.path.join(processed_folder, relative_path)
-
-            # Create the processed directory if it doesn't exist
-            os.makedirs(os.path.dirname(processed_path), exist_ok=True)
+            # Move the new MP4 file to the processed directory
+            processed_path = os.path.join(processed_dir, os.path.basename(mp4_path))
+            ensure_dir(processed_dir)
 
             # Move the file
             try:
-                shutil.move(mp4_path, processed_path)
+                move_file(mp4_path, processed_path)
                 logger.info(f"Moved file: {mp4_path} -> {processed_path}")
             except Exception as e:
                 logger.error(f"Failed to move file {mp4_path} to {processed_path}: {e}")
@@ -331,138 +630,287 @@ def update_video_metadata(media_path, metadata, processed_folder):
 
 def get_metadata_from_json(json_path):
     """Load metadata from a JSON file."""
-    if os.path.exists(json_path):
+    try:
+        with open(json_path, 'rb') as f:
+            data = json_loads(f.read())
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.error(f"Failed to load JSON file {json_path}: {e}")
+        return {}
+
+    # Keep only the fields that are written to the media files
+    if not isinstance(data, dict):
+        return {}
+    return {field: data[field] for field in METADATA_FIELDS if field in data}
+
+def walk(top):
+    """Walk a directory tree with a single os.scandir per directory.
+
+    Yields (dirpath, file_entries, dir_entries) for every directory, parents
+    before children. The entries are os.DirEntry objects, so their name, path
+    and file type come from the directory listing without extra stat calls.
+    Symbolic links to directories are not followed.
+    """
+    stack = [top]
+    while stack:
+        dirpath = stack.pop()
+        file_entries = []
+        dir_entries = []
         try:
-            with open(json_path, 'r') as f:
-                return json.load(f)
-        except Exception as e:
-            logger.error(f"Failed to load JSON file {json_path}: {e}")
-            return {}
-    return {}
-
-def find_json_file_for_media(media_path):
+            with os.scandir(dirpath) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        dir_entries.append(entry)
+                    elif entry.is_file():
+                        file_entries.append(entry)
+        except OSError as e:
+            logger.error(f"Failed to scan directory {dirpath}: {e}")
+            continue
+        yield dirpath, file_entries, dir_entries
+        # Pushed in reverse so subdirectories are visited in listing order
+        stack.extend(entry.path for entry in reversed(dir_entries))
+
+def build_json_index(json_entries):
+    """Index the JSON files of a directory by every dot-delimited prefix of their name."""
+    json_index = {}
+    for entry in json_entries:
+        # IMG_1.jpg.supplemental-metadata.json is reachable from IMG_1, IMG_1.jpg, ...
+        name = entry.name
+        dot = name.find('.')
+        while dot != -1:
+            json_index.setdefault(name[:dot], entry.path)
+            dot = name.find('.', dot + 1)
+    return json_index
+
+def find_json_file_for_media(media_name, json_index):
     """Find the corresponding JSON file for a media file."""
-    base_name = os.path.splitext(media_path)[0]
-    directory = os.path.dirname(media_path)
-
-    # Look for any JSON file that starts with the base name and ends with .json
-    for file in os.listdir(directory):
-        if file.startswith(os.path.basename(base_name)) and file.endswith(".json"):
-            return os.path.join(directory, file)
-    
-    return None
-
-def get_photo_taken_time_from_directory(directory):
-    """Get the photoTakenTime from any media file in the directory."""
-    for root, _, files in os.walk(directory):
-        for file in files:
-            if not file.endswith('.json'):
-                media_path = os.path.join(root, file)
-                json_path = find_json_file_for_media(media_path)
-
-                if json_path:
-                    metadata = get_metadata_from_json(json_path)
-                    if metadata and 'photoTakenTime' in metadata:
-                        return metadata['photoTakenTime'].get('timestamp')
-    return None
-
-def merge_metadata(media_folder, processed_folder):
-    """Merge metadata from JSON files into media files."""
-    logger.info(f"Starting metadata update for folder: {media_folder}")
+    return json_index.get(os.path.splitext(media_name)[0])
 
-    # Dictionary to store results for each directory
-    results = {}
+def move_to_processed(media_path, processed_dir):
+    """Move an updated media file to its directory in the processed folder."""
+    processed_path = os.path.join(processed_dir, os.path.basename(media_path))
+    try:
+        ensure_dir(processed_dir)
+        move_file(media_path, processed_path)
+        logger.info(f"Moved file: {media_path} -> {processed_path}")
+    except Exception as e:
+        logger.error(f"Failed to move file {media_path} to {processed_path}: {e}")
 
-    for root, dirs, files in os.walk(media_folder):
-        # Initialize counters for the current directory
-        initial_file_count = 0
-        updated_file_count = 0
-        unprocessed_file_count = 0
+def handle_photo(media_path, metadata, directory_photo_taken_time, processed_dir):
+    """Update the metadata of a photo and move it to the processed directory."""
+    if not update_photo_metadata(media_path, metadata, directory_photo_taken_time):
+        return False
+    move_to_processed(media_path, processed_dir)
+    return True
 
-        # Get the photoTakenTime from any media file in the directory
-        directory_photo_taken_time = get_photo_taken_time_from_directory(root)
+def handle_nef(media_path, metadata, directory_photo_taken_time, processed_dir):
+    """Convert a .nef photo to .jpg with metadata and move the .jpg to the processed directory."""
+    if not update_photo_metadata(media_path, metadata, directory_photo_taken_time):
+        return False
+    move_to_processed(os.path.splitext(media_path)[0] + ".jpg", processed_dir)
+    return True
+
+def handle_video(media_path, metadata, directory_photo_taken_time, processed_dir):
+    """Update the metadata of an MP4/MOV video and move it to the processed directory."""
+    if not update_video_metadata(media_path, metadata, processed_dir):
+        return False
+    move_to_processed(media_path, processed_dir)
+    return True
+
+def handle_video_transcode(media_path, metadata, directory_photo_taken_time, processed_dir):
+    """Convert a video to MP4 with metadata, update_video_metadata moves the MP4 itself."""
+    with transcode_slots:
+        return update_video_metadata(media_path, metadata, processed_dir)
+
+def handle_gif(media_path, metadata, directory_photo_taken_time, processed_dir):
+    """Move a GIF file to the processed directory without modifying metadata."""
+    move_to_processed(media_path, processed_dir)
+    return True
+
+# Handler for every supported (lowercase) media file extension
+HANDLERS = {
+    '.jpg': handle_photo,
+    '.jpeg': handle_photo,
+    '.png': handle_photo,
+    '.nef': handle_nef,
+    '.mp4': handle_video,
+    '.mov': handle_video,
+    '.wmv': handle_video_transcode,
+    '.avi': handle_video_transcode,
+    '.mpg': handle_video_transcode,
+    '.3gp': handle_video_transcode,
+    '.gif': handle_gif,
+}
+
+def process_media_file(media_path, metadata, directory_photo_taken_time, processed_dir):
+    """Update the metadata of a media file and move it to its directory in the processed folder."""
+    handler = HANDLERS.get(os.path.splitext(media_path)[1].lower())
+    if handler is None:
+        logger.warning(f"Skipping unsupported file type: {os.path.basename(media_path)}")
+        return False
+    return handler(media_path, metadata, directory_photo_taken_time, processed_dir)
 
-        # List to store paths of successfully updated files
-        updated_files = []
+def scan_media_folder(media_folder, processed_folder, work_queue, results, results_lock, num_workers, stop_event):
+    """Walk the media folder and queue every media file that can be updated for the workers."""
+    # photoTakenTime of every directory visited so far, inherited by subdirectories without one
+    dir_taken_time = {}
 
-        for file in files:
-            if not file.endswith('.json'):
-                media_path = os.path.join(root, file)
-                json_path = find_json_file_for_media(media_path)
+    try:
+        for root, file_entries, _ in walk(media_folder):
+            if stop_event.is_set():
+                return
+
+            # Split the files of the directory into JSON sidecars and media files
+            media_entries = []
+            json_entries = []
+            for entry in file_entries:
+                if entry.name.endswith('.json'):
+                    json_entries.append(entry)
+                else:
+                    media_entries.append(entry)
+
+            # Initialize counters for the current directory
+            with results_lock:
+                results[root] = {
+                    "initial_file_count": len(media_entries),
+                    "updated_file_count": 0,
+                    "unprocessed_file_count": 0,
+                }
+
+            # Get the photoTakenTime from the first JSON file in the directory that has one
+            directory_photo_taken_time = None
+            for json_entry in json_entries:
+                metadata = get_metadata_from_json(json_entry.path)
+                if metadata and 'photoTakenTime' in metadata:
+                    directory_photo_taken_time = metadata['photoTakenTime'].get('timestamp')
+                    break
+
+            # Otherwise inherit it from the parent directory (already visited, parents come first).
+            # Both keys are normalized, so "./Albums" or "E:/takeout" style roots match as well
+            if not directory_photo_taken_time:
+                directory_photo_taken_time = dir_taken_time.get(os.path.normpath(os.path.dirname(root)))
+            dir_taken_time[os.path.normpath(root)] = directory_photo_taken_time
+
+            # Without JSON files or an inherited timestamp none of the media files can be updated
+            if not json_entries and not directory_photo_taken_time:
+                if media_entries:
+                    logger.warning(f"No JSON file or directory timestamp found for the {len(media_entries)} media files in: {root}")
+                    with results_lock:
+                        results[root]["unprocessed_file_count"] = len(media_entries)
+                continue
+
+            # Index the JSON files of the directory once for all of its media files
+            json_index = build_json_index(json_entries)
+
+            # Directory of the processed folder that receives the media files of this directory
+            relative_root = os.path.relpath(root, media_folder)
+            processed_dir = processed_folder if relative_root == os.curdir else os.path.join(processed_folder, relative_root)
+
+            for entry in media_entries:
+                file = entry.name
+                media_path = entry.path
+                json_path = find_json_file_for_media(file, json_index)
 
                 # Debug: Print media file and JSON file paths
                 logger.debug(f"Media file: {media_path}")
                 logger.debug(f"JSON file: {json_path}")
 
-                # Increment initial file count
-                initial_file_count += 1
-
                 metadata = get_metadata_from_json(json_path) if json_path else {}
 
                 if metadata or directory_photo_taken_time:
-                    if file.lower().endswith(('.jpg', '.jpeg', '.png', '.nef')):
-                        # Handle photos (including .dng files if no corresponding .JPG exists)
-                        if update_photo_metadata(media_path, metadata, directory_photo_taken_time):
-                            updated_file_count += 1
-                            # Add the updated file to the list (use the new .jpg path if it was converted from .nef)
-                            if media_path.lower().endswith('.nef'):
-                                updated_files.append(os.path.splitext(media_path)[0] + ".jpg")
-                            else:
-                                updated_files.append(media_path)
-                        else:
-                            unprocessed_file_count += 1
-
-                    elif file.lower().endswith(('.mp4', '.mov', '.avi', '.wmv', '.mpg', '.3gp')):
-                        # Handle videos
-                        if update_video_metadata(media_path, metadata, processed_folder):
-                            updated_file_count += 1
-                            updated_files.append(media_path)  # Add to updated_files list
-                        else:
-                            unprocessed_file_count += 1
-
-                    elif file.lower().endswith('.gif'):
-                        # Handle GIF files (copy without modifying metadata)
-                        updated_file_count += 1
-                        updated_files.append(media_path)  # Add to updated_files list
-
-                    else:
-                        logger.warning(f"Skipping unsupported file type: {file}")
-                        unprocessed_file_count += 1
+                    # Waits while the queue is full, so the scan never runs too far ahead of the workers
+                    item = (root, media_path, metadata, directory_photo_taken_time, processed_dir)
+                    while True:
+                        if stop_event.is_set():
+                            return
+                        try:
+                            work_queue.put(item, timeout=0.1)
+                            break
+                        except queue.Full:
+                            pass
                 else:
                     logger.warning(f"No JSON file or directory timestamp found for: {file}")
-                    unprocessed_file_count += 1
+                    with results_lock:
+                        results[root]["unprocessed_file_count"] += 1
+    except Exception as e:
+        logger.error(f"Error while scanning {media_folder}: {e}")
+    finally:
+        # One end marker per worker, even if the scan failed (merge_metadata sends them when stopped)
+        if not stop_event.is_set():
+            for _ in range(num_workers):
+                work_queue.put(None)
+
+def process_queued_files(work_queue, results, results_lock, stop_event):
+    """Process the media files of the work queue until the end marker is received or the run is stopped."""
+    while True:
+        item = work_queue.get()
+        if item is None or stop_event.is_set():
+            return
+        root, media_path, metadata, directory_photo_taken_time, processed_dir = item
+        try:
+            updated = process_media_file(media_path, metadata, directory_photo_taken_time, processed_dir)
+        except Exception as e:
+            logger.error(f"Unexpected error while processing {media_path}: {e}")
+            updated = False
+        with results_lock:
+            results[root]["updated_file_count" if updated else "unprocessed_file_count"] += 1
 
-        # Store results for the current directory
-        results[root] = {
-            "initial_file_count": initial_file_count,
-            "updated_file_count": updated_file_count,
-            "unprocessed_file_count": unprocessed_file_count,
-        }
+def merge_metadata(media_folder, processed_folder, max_workers=MAX_WORKERS):
+    """Merge metadata from JSON files into media files."""
+    summary_logger.info(f"Starting metadata update for folder: {media_folder}")
 
-        # Move updated files to the processed folder
-        logger.info(f"Moving updated files to: {processed_folder}")
-        for media_path in updated_files:
-            relative_path = os.path.relpath(media_path, media_folder)
-            processed_path = os.path.join(processed_folder, relative_path)
+    # Dictionary to store results for each directory
+    results = {}
+    results_lock = threading.Lock()
 
-            # Create the processed directory if it doesn't exist
-            os.makedirs(os.path.dirname(processed_path), exist_ok=True)
+    # Processed directories are created when the first file is moved into them
+    created_dirs.clear()
 
-            # Move the file
+    # The scan thread fills the queue while the workers update and move the files
+    work_queue = queue.Queue(maxsize=QUEUE_SIZE)
+    stop_event = threading.Event()  # Set on Ctrl-C, stops the scan and the workers
+    threads = [
+        threading.Thread(target=process_queued_files, args=(work_queue, results, results_lock, stop_event))
+        for _ in range(max_workers)
+    ]
+    threads.append(threading.Thread(
+        target=scan_media_folder,
+        args=(media_folder, processed_folder, work_queue, results, results_lock, max_workers, stop_event),
+    ))
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            # Joined with a timeout so Ctrl-C also reaches the main thread on Windows
+            while thread.is_alive():
+                thread.join(0.5)
+    except KeyboardInterrupt:
+        summary_logger.warning("Interrupted, waiting for the files being processed to finish...")
+        stop_event.set()
+        # Drop the queued files and wake up the idle workers
+        while True:
             try:
-                shutil.move(media_path, processed_path)
-                logger.info(f"Moved file: {media_path} -> {processed_path}")
-            except Exception as e:
-                logger.error(f"Failed to move file {media_path} to {processed_path}: {e}")
+                work_queue.get_nowait()
+            except queue.Empty:
+                break
+        for _ in range(max_workers):
+            work_queue.put(None)
+        for thread in threads:
+            thread.join()
+        raise
+    finally:
+        # Stop the exiftool process shared by the video conversions
+        exiftool_server.close()
 
     # Log the results for each directory
     for directory, stats in results.items():
-        logger.info(f"Directory: {directory}")
-        logger.info(f"  Initial file count: {stats['initial_file_count']}")
-        logger.info(f"  Updated file count: {stats['updated_file_count']}")
-        logger.info(f"  Unprocessed file count: {stats['unprocessed_file_count']}")
+        summary_logger.info(f"Directory: {directory}")
+        summary_logger.info(f"  Initial file count: {stats['initial_file_count']}")
+        summary_logger.info(f"  Updated file count: {stats['updated_file_count']}")
+        summary_logger.info(f"  Unprocessed file count: {stats['unprocessed_file_count']}")
 
-    logger.info("Metadata update and file move completed.")
+    summary_logger.info("Metadata update and file move completed.")
 
 # Set the folder containing your media and JSON files
 media_folder = "E:\\takeout\\Takeout\\Albums"
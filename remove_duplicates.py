@@ -1,187 +1,287 @@
 import os
-import json
-import re
+import atexit
 import logging
-from collections import defaultdict
+import logging.handlers
+import functools
+import queue
+from collections import defaultdict, deque, namedtuple
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
-# Set up logging
+# orjson parses the metadata files several times faster, fall back to the json module without it
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# Set up logging: the comparison only puts records on a queue, a listener thread writes them
+log_formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+log_handlers = [
+    logging.FileHandler("deduplication.log", mode='w', encoding='utf-8'),  # Log to a file with UTF-8 encoding
+    logging.StreamHandler()  # Log to the console
+]
+for handler in log_handlers:
+    handler.setFormatter(log_formatter)
+log_queue = queue.SimpleQueue()
+log_listener = logging.handlers.QueueListener(log_queue, *log_handlers)
 logging.basicConfig(
     level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler("deduplication.log", mode='w', encoding='utf-8'),  # Log to a file with UTF-8 encoding
-        logging.StreamHandler()  # Log to the console
-    ]
+    format="%(message)s",  # Formatted by the listener's handlers
+    handlers=[logging.handlers.QueueHandler(log_queue)]
 )
+log_listener.start()
+atexit.register(log_listener.stop)  # Runs before logging closes the handlers
+logger = logging.getLogger(__name__)
+
+# A scanned media file, with the parts of its path computed once during the scan
+MediaFile = namedtuple("MediaFile", ["path", "root", "name", "base_name_without_ext", "ext", "json_files"])
+
+# Number of media files whose metadata is loaded by one worker task
+METADATA_BATCH_SIZE = 256
+
+# Number of threads removing duplicate files (each removal mostly waits on the disk)
+REMOVE_WORKERS = 16
 
-def find_metadata_file(media_file):
-    """Find the corresponding metadata file for a media file, handling all naming patterns."""
-    base_name = os.path.basename(media_file)
-    base_name_without_ext, ext = os.path.splitext(base_name)
-    directory = os.path.dirname(media_file)
+def split_counter(base_name_without_ext):
+    """Split the counter suffix (e.g., "(507)") off a media file name without extension."""
+    if base_name_without_ext.endswith(")"):
+        i = base_name_without_ext.rfind("(")
+        counter = base_name_without_ext[i + 1:-1]
+        if i >= 0 and counter.isdecimal():
+            return base_name_without_ext[:i], counter
+    return base_name_without_ext, None
 
+def find_metadata_file(directory, base_name, base_name_without_ext, ext, json_list):
+    """Find the corresponding metadata file for a media file among the JSON files of its directory."""
     # Extract the counter suffix (e.g., "(507)") from the media file name
-    counter_match = re.match(r"^(.*?)\((\d+)\)$", base_name_without_ext)
-    if counter_match:
-        base_name_without_counter = counter_match.group(1)
-        counter = counter_match.group(2)
-    else:
-        base_name_without_counter = base_name_without_ext
-        counter = None
-
-    # Search for metadata files matching the patterns
-    for file in os.listdir(directory):
-        if file.endswith(".json"):
-            # Case 1: {originalfilename}.json (exact match)
-            if file == f"{base_name}.json":
-                return os.path.join(directory, file)
+    base_name_without_counter, counter = split_counter(base_name_without_ext)
+
+    # Case-insensitive prefixes and suffixes of the metadata file names
+    base_name_cf = base_name.casefold()
+    base_name_without_counter_cf = base_name_without_counter.casefold()
+    case1_name = base_name_cf + ".json"
+    case2_prefix = base_name_cf + "."
+    if counter:
+        counter_tag = f"({counter})"
+        case3_prefix = base_name_without_counter_cf + "."
+        case3_suffix = counter_tag + ".json"
+        case4_prefix = base_name_without_counter_cf + counter_tag + ext.casefold() + "."
+
+    # Search for metadata files matching the patterns, json_list holds (name, casefolded name)
+    # pairs of files whose names end with ".json"
+    for file, file_cf in json_list:
+        # Case 1: {originalfilename}.json (exact match)
+        if file_cf == case1_name:
+            return os.path.join(directory, file)
 
-            # Case 2: {originalfilename}.{originalfileextension}.{sometext}.json (no counter)
-            metadata_match_case2 = re.match(
-                rf"^{re.escape(base_name)}\.[^()]+\.json$",
-                file,
-                re.IGNORECASE  # Case-insensitive matching
-            )
-            if metadata_match_case2:
+        # Case 2: {originalfilename}.{originalfileextension}.{sometext}.json (no counter)
+        if file_cf.startswith(case2_prefix) and len(file_cf) > len(case2_prefix) + 5:
+            middle = file_cf[len(case2_prefix):-5]
+            if "(" not in middle and ")" not in middle:
                 return os.path.join(directory, file)
 
+        if counter:
             # Case 3: {originalfilename}.{sometext}{counter}.json
-            if counter:
-                metadata_match_case3 = re.match(
-                    rf"^{re.escape(base_name_without_counter)}\..+?\({counter}\)\.json$",
-                    file,
-                    re.IGNORECASE  # Case-insensitive matching
-                )
-                if metadata_match_case3:
-                    return os.path.join(directory, file)
+            if (file_cf.startswith(case3_prefix) and file_cf.endswith(case3_suffix)
+                    and len(file_cf) > len(case3_prefix) + len(case3_suffix)):
+                return os.path.join(directory, file)
 
             # Case 4: {originalfilename}{counter}.{originalfileextension}.{sometext}.json
-            if counter:
-                metadata_match_case4 = re.match(
-                    rf"^{re.escape(base_name_without_counter)}\({counter}\)\{re.escape(ext)}\..+?\.json$",
-                    file,
-                    re.IGNORECASE  # Case-insensitive matching
-                )
-                if metadata_match_case4:
-                    return os.path.join(directory, file)
+            if file_cf.startswith(case4_prefix) and len(file_cf) > len(case4_prefix) + 5:
+                return os.path.join(directory, file)
 
     return None
 
-def load_metadata(media_file):
-    """Load metadata from the corresponding JSON file."""
-    metadata_file = find_metadata_file(media_file)
-    if metadata_file and os.path.exists(metadata_file):
-        with open(metadata_file, "r") as f:
-            return {"path": metadata_file, "data": json.load(f)}
-    return None
+def extract_fields(metadata):
+    """Extract the photoTakenTime timestamp and the lowercase title from the metadata."""
+    photo_taken_time = metadata.get("photoTakenTime")
+    if photo_taken_time is not None:
+        photo_taken_time = photo_taken_time["timestamp"]
+    title = metadata.get("title")
+    if title is not None:
+        title = str(title).lower()
+    return photo_taken_time, title
 
-def get_photo_taken_time(metadata):
-    """Extract the photoTakenTime from the metadata."""
-    if metadata and "photoTakenTime" in metadata:
-        return metadata["photoTakenTime"]["timestamp"]
-    return None
+@functools.lru_cache(maxsize=65536)
+def _load_metadata_fields(metadata_file):
+    """Parse a metadata file, once even if it is shared by several media files, and extract its fields."""
+    with open(metadata_file, "rb") as f:
+        return extract_fields(json_loads(f.read()))
 
-def get_title(metadata):
-    """Extract the title from the metadata."""
-    if metadata and "title" in metadata:
-        return str(metadata["title"]).lower()
+def load_metadata(media):
+    """Load the (path, photoTakenTime, title) of the JSON file corresponding to a MediaFile."""
+    metadata_file = find_metadata_file(media.root, media.name, media.base_name_without_ext, media.ext, media.json_files)
+    if metadata_file:
+        # The file name comes from the directory listing, so it only fails if it was removed since
+        try:
+            return (metadata_file, *_load_metadata_fields(metadata_file))
+        except FileNotFoundError:
+            pass
     return None
 
-def group_files_by_name_and_metadata(directory):
-    """Group files by their base name and photoTakenTime, preserving directory structure."""
-    name_to_files = defaultdict(list)
-    for root, _, files in os.walk(directory):
-        for file in files:
-            if file.endswith(".json"):  # Skip metadata files
-                continue
-            file_path = os.path.join(root, file)
-            base_name = os.path.splitext(file)[0].lower()  # Normalize name
-            metadata_file = load_metadata(file_path)
-            metadata_json = ""
-            metadata_path = ""
-            photo_taken_time = ""
-            title = ""
-            if metadata_file:
-                metadata_json = metadata_file["data"]
-                metadata_path = metadata_file["path"]
-                photo_taken_time = get_photo_taken_time(metadata_json)
-                title = get_title(metadata_json)
+class TitleBucket:
+    """Media files sharing a title, stored as parallel lists of paths and photoTakenTimes."""
+    __slots__ = ("file_paths", "json_paths", "times")
+
+    def __init__(self):
+        self.file_paths = []
+        self.json_paths = []
+        self.times = []
+
+    def __len__(self):
+        return len(self.file_paths)
+
+    def append(self, file_path, json_path, photo_taken_time):
+        """Add a media file to the bucket."""
+        self.file_paths.append(file_path)
+        self.json_paths.append(json_path)
+        self.times.append(photo_taken_time)
+
+def load_metadata_batch(media_files):
+    """Load the metadata of a batch of media files."""
+    return [load_metadata(media) for media in media_files]
+
+def scan_media_files(directory):
+    """Collect the MediaFile entries of a directory tree."""
+    media_files = []
+    pending = deque([directory])
+    while pending:
+        root = pending.popleft()
+        # Split the directory into metadata files and media files; the media files share
+        # the directory's json_files list, which is complete before any metadata is looked up
+        json_files = []
+        try:
+            with os.scandir(root) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(entry.path)
+                    elif entry.is_file():
+                        if entry.name.endswith(".json"):
+                            # Casefolded once here instead of once per media file of the directory
+                            json_files.append((entry.name, entry.name.casefold()))
+                        else:
+                            base_name_without_ext, ext = os.path.splitext(entry.name)
+                            media_files.append(MediaFile(entry.path, root, entry.name, base_name_without_ext, ext, json_files))
+        except OSError as e:
+            logger.error("Failed to scan directory %s: %s", root, e)
+    return media_files
+
+def media_key(base_name_without_ext):
+    """Lowercase name of a media file without its extension and counter suffix."""
+    return split_counter(base_name_without_ext)[0].lower()
+
+def group_files_by_name_and_metadata(media_files, max_workers=8):
+    """Group media files by their title and photoTakenTime, preserving directory structure."""
+    name_to_files = defaultdict(TitleBucket)
+
+    # Load the metadata files in parallel, in batches to keep the per-task overhead low
+    batches = [media_files[i:i + METADATA_BATCH_SIZE] for i in range(0, len(media_files), METADATA_BATCH_SIZE)]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        metadata_batches = list(executor.map(load_metadata_batch, batches))
+
+    # Group the files on this thread, the results come back in the order of media_files
+    for batch, metadata_batch in zip(batches, metadata_batches):
+        for media, metadata in zip(batch, metadata_batch):
+            if metadata:
+                metadata_path, photo_taken_time, title = metadata
             else:
-                title = base_name
-            
-            obj = {"base_name": file, "photo_taken_time": photo_taken_time, "file_path": file_path, "json_path": metadata_path}
-            name_to_files[title].append(obj)
+                metadata_path = ""
+                photo_taken_time = ""
+                title = media.base_name_without_ext.lower()  # Normalize name
+
+            name_to_files[title].append(media.path, metadata_path, photo_taken_time)
     return name_to_files
 
 def find_duplicates(albums_directory, photos_directory, max_workers=8):
     """Find duplicate files in the Photos directory that exist in the Albums directory."""
-    # Step 1: Group files by base name and photoTakenTime in both directories
-    albums_name_to_files = group_files_by_name_and_metadata(albums_directory)
-    photos_name_to_files = group_files_by_name_and_metadata(photos_directory)
+    # Step 1: List the media files of both directories
+    albums_media_files = scan_media_files(albums_directory)
+    photos_media_files = scan_media_files(photos_directory)
+
+    # Only files whose name appears in both directories can be duplicates, the metadata of
+    # the other files is never loaded
+    albums_keys = [media_key(media.base_name_without_ext) for media in albums_media_files]
+    photos_keys = [media_key(media.base_name_without_ext) for media in photos_media_files]
+    shared_keys = set(albums_keys).intersection(photos_keys)
+    albums_media_files = [media for media, key in zip(albums_media_files, albums_keys) if key in shared_keys]
+    photos_media_files = [media for media, key in zip(photos_media_files, photos_keys) if key in shared_keys]
+
+    # Step 2: Group files by title and photoTakenTime in both directories
+    albums_name_to_files = group_files_by_name_and_metadata(albums_media_files, max_workers)
+    photos_name_to_files = group_files_by_name_and_metadata(photos_media_files, max_workers)
+    # Paths to remove, in the order they are found, and the same paths for the membership checks
     duplicates = []
+    seen = set()
     count_media = 0
     
-    # Step 2: Compare files with the same base name and photoTakenTime
-    for title, photos_files in photos_name_to_files.items():
-        if title in albums_name_to_files:
-            album_files = albums_name_to_files[title]
-            if len(photos_files) == 1 and len(album_files) == 1:
-                # These files are duplicates
-                duplicates.append(photos_files[0]["file_path"])
-                duplicates.append(photos_files[0]["json_path"])
-                count_media = count_media + 1
-                logging.info(f"Duplicate found: {album_files[0]["file_path"]} -> {photos_files[0]["file_path"]}")
-            elif len(photos_files) > 1 and len(album_files) == 1:
-                logging.info(f"{title}: {photos_files}")
-                for gp in photos_files:
-                    if album_files[0]["photo_taken_time"] == gp["photo_taken_time"]:
-                        duplicates.append(gp["file_path"])
-                        duplicates.append(gp["json_path"])
-                        count_media = count_media + 1
-                        logging.info(f"Duplicate found: {album_files[0]["file_path"]} -> {gp["file_path"]}")
-            elif len(photos_files) == 1 and len(album_files) > 1:
-                logging.info(f"{title}: {album_files}")
-                for alb in album_files:
-                    if photos_files[0]["photo_taken_time"] == alb["photo_taken_time"]:
-                        duplicates.append(photos_files[0]["file_path"])
-                        duplicates.append(photos_files[0]["json_path"])
-                        count_media = count_media + 1
-                        logging.info(f"Duplicate found: {alb["file_path"]} -> {photos_files[0]["file_path"]}")
-            elif len(photos_files) > 1 and len(album_files) > 1:
-                logging.info(f"{title}: {album_files} -> {photos_files}")
-                for gp in photos_files:
-                    for alb in album_files:
-                        if gp["photo_taken_time"] == alb["photo_taken_time"]:
-                            duplicates.append(gp["file_path"])
-                            duplicates.append(gp["json_path"])
-                            count_media = count_media + 1
-                            logging.info(f"Duplicate found: {alb["file_path"]} -> {gp["file_path"]}")
-                            break
-    duplicates = list(set(duplicates))
-    logging.info(f"Found {count_media} duplicates.")
+    # Step 3: Index the album files by title and photoTakenTime
+    albums_by_key = {}
+    for title, album_files in albums_name_to_files.items():
+        for album_path, photo_taken_time in zip(album_files.file_paths, album_files.times):
+            albums_by_key.setdefault((title, photo_taken_time), album_path)
+
+    # Step 4: Look up every photo with the same title and photoTakenTime in the albums, visiting
+    # the titles of whichever side has fewer of them
+    if len(photos_name_to_files) <= len(albums_name_to_files):
+        title_groups = (
+            (title, photos_files, albums_name_to_files.get(title))
+            for title, photos_files in photos_name_to_files.items()
+        )
+    else:
+        title_groups = (
+            (title, photos_name_to_files.get(title), album_files)
+            for title, album_files in albums_name_to_files.items()
+        )
+    for title, photos_files, album_files in title_groups:
+        if photos_files is None or album_files is None:
+            continue
+        if len(photos_files) == 1 and len(album_files) == 1:
+            # A single file with this title on both sides is a duplicate whatever its time
+            matches = [(0, album_files.file_paths[0])]
+        else:
+            logger.info("%s: %s -> %s", title, album_files.file_paths, photos_files.file_paths)
+            matches = []
+            for i, photo_taken_time in enumerate(photos_files.times):
+                album_path = albums_by_key.get((title, photo_taken_time))
+                if album_path is not None:
+                    matches.append((i, album_path))
+
+        for i, album_path in matches:
+            count_media = count_media + 1
+            logger.info("Duplicate found: %s -> %s", album_path, photos_files.file_paths[i])
+            for path in (photos_files.file_paths[i], photos_files.json_paths[i]):
+                # Media files without metadata have an empty json_path
+                if path and path not in seen:
+                    seen.add(path)
+                    duplicates.append(path)
+    logger.info("Found %d duplicates.", count_media)
 
     return duplicates
 
-def remove_duplicates(duplicates):
+def _safe_remove(file_path):
+    """Remove a file, logging instead of raising if it cannot be removed."""
+    try:
+        logger.info("Removing duplicate: %s", file_path)
+        os.remove(file_path)
+    except (IOError, OSError) as e:
+        logger.error("Failed to remove %s: %s", file_path, e)
+
+def remove_duplicates(duplicates, max_workers=REMOVE_WORKERS):
     """Remove duplicate files from the Photos directory."""
-    for file_path in duplicates:
-        try:
-            logging.info(f"Removing duplicate: {file_path}")
-            os.remove(file_path)
-        except (IOError, OSError) as e:
-            logging.error(f"Failed to remove {file_path}: {e}")
+    # Remove the files directory by directory, in name order within each directory
+    file_paths = sorted(duplicates, key=lambda file_path: os.path.split(file_path))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(_safe_remove, file_paths))
 
 # Define directories
 albums_directory = "E:\\takeout\\Takeout\\Albums"  # Directory containing your albums
 photos_directory = "E:\\takeout\\Takeout\\Photos"  # Directory to clean up
 
 # Find and remove duplicates
-logging.info("Starting duplicate detection...")
+logger.info("Starting duplicate detection...")
 duplicates = find_duplicates(albums_directory, photos_directory, max_workers=8)
 
-logging.info("Starting duplicate removal...")
+logger.info("Starting duplicate removal...")
 remove_duplicates(duplicates)
-logging.info("Duplicate removal completed.")
+logger.info("Duplicate removal completed.")
 
 print(f"Removed duplicates from '{photos_directory}'.")
\ No newline at end of file